@@ -7,7 +7,9 @@ challenge.
 Author: Titouan Lorieul <titouan.lorieul@gmail.com>
 """
 
+import os
 from pathlib import Path
+from typing import Any, Optional
 
 import hydra
 import numpy as np
@@ -15,18 +17,24 @@ import pytorch_lightning as pl
 import torch
 from omegaconf import DictConfig
 from pytorch_lightning.callbacks import ModelCheckpoint
-from torchvision import transforms
-from transforms import PreprocessRGBTemperatureData
+from torchvision.transforms import v2 as transforms
+from transforms import (PreprocessRGBTemperatureData,
+                        random_rotation_flip_batch)
 
 from malpolon.data.data_module import BaseDataModule
 from malpolon.data.datasets.geolifeclef2022 import (GeoLifeCLEF2022Dataset,
                                                     MiniGeoLifeCLEF2022Dataset)
-from malpolon.data.environmental_raster import PatchExtractor
+from malpolon.data.environmental_raster import (MemmapPatchExtractor,
+                                                PatchExtractor)
 from malpolon.logging import Summary
 from malpolon.models.custom_models.multi_modal import \
     HomogeneousMultiModalModel
 from malpolon.models.standard_prediction_systems import ClassificationSystem
 
+# Normalization constants of the stacked RGB and temperature channels
+NORMALIZATION_MEAN = torch.tensor([0.485, 0.456, 0.406] * 2)[:, None, None]
+NORMALIZATION_STD = torch.tensor([0.229, 0.224, 0.225] * 2)[:, None, None]
+
 
 class GeoLifeCLEF2022DataModule(BaseDataModule):
     r"""
@@ -38,39 +46,43 @@ class GeoLifeCLEF2022DataModule(BaseDataModule):
         minigeolifeclef: if True, loads MiniGeoLifeCLEF 2022, otherwise loads GeoLifeCLEF2022
         train_batch_size: Size of batch for training
         inference_batch_size: Size of batch for inference (validation, testing, prediction)
-        num_workers: Number of workers to use for data loading
+        num_workers: Number of workers to use for data loading, if None uses as many as there are CPUs per process, up to 8
+        cache_env_patches: if True, extracts the environmental patches of each split once (in `prepare_data`) and memory-maps them in the next runs
+        in_memory: if True, loads all the patches of each split at once: in RAM for MiniGeoLifeCLEF, memory-mapped from `<dataset_path>/cache/` (written in `prepare_data`) otherwise
+        cuda_prefetch: if True, copies the next training batch to the GPU on a side CUDA stream while the current one is processed
+        val_on_gpu: if True, loads the transformed validation set once in GPU memory (if it fits) and iterates over it without workers
     """
+    patch_data = ["rgb"]
+    rasters = {"bio_1": -12.0, "bio_2": 1.0, "bio_7": 1.0}  # Raster names and the values replacing their NaNs
+    patch_size = 20
+
     def __init__(
         self,
         dataset_path: str,
         minigeolifeclef: bool = False,
         train_batch_size: int = 32,
         inference_batch_size: int = 256,
-        num_workers: int = 8,
+        num_workers: Optional[int] = None,
         task: str = 'classification_multiclass',
+        cache_env_patches: bool = False,
+        in_memory: bool = False,
+        cuda_prefetch: bool = False,
+        val_on_gpu: bool = False,
     ):
-        super().__init__(train_batch_size, inference_batch_size, num_workers)
+        super().__init__(train_batch_size, inference_batch_size, num_workers, cuda_prefetch=cuda_prefetch,
+                         val_on_gpu=val_on_gpu)
         self.dataset_path = dataset_path
         self.minigeolifeclef = minigeolifeclef
         self.task = task
+        self.cache_env_patches = cache_env_patches
+        self.in_memory = in_memory
 
     @property
     def train_transform(self):
         return transforms.Compose(
             [
                 PreprocessRGBTemperatureData(),
-                transforms.RandomRotation(degrees=45, fill=1),
                 transforms.RandomCrop(size=224),
-                transforms.RandomHorizontalFlip(),
-                transforms.RandomVerticalFlip(),
-                transforms.Normalize(
-                    mean=[0.485, 0.456, 0.406] * 2,
-                    std=[0.229, 0.224, 0.225] * 2,
-                ),
-                transforms.Lambda(lambda x: {
-                    "rgb": x[:3],
-                    "temperature": x[3:],
-                }),
             ]
         )
 
@@ -80,37 +92,80 @@ class GeoLifeCLEF2022DataModule(BaseDataModule):
             [
                 PreprocessRGBTemperatureData(),
                 transforms.CenterCrop(size=224),
-                transforms.Normalize(
-                    mean=[0.485, 0.456, 0.406] * 2,
-                    std=[0.229, 0.224, 0.225] * 2,
-                ),
-                transforms.Lambda(lambda x: {
-                    "rgb": x[:3],
-                    "temperature": x[3:],
-                }),
             ]
         )
 
+    @property
+    def dataset_cls(self):
+        return MiniGeoLifeCLEF2022Dataset if self.minigeolifeclef else GeoLifeCLEF2022Dataset
+
+    def _get_patch_extractor(self):
+        patch_extractor = PatchExtractor(Path(self.dataset_path) / "rasters", size=self.patch_size)
+        for raster_name, nan in self.rasters.items():
+            patch_extractor.append(raster_name, nan=nan)
+        return patch_extractor
+
+    def _use_env_cache(self, split):
+        # MiniGeoLifeCLEF's test observations are randomly drawn, hence not cached
+        return self.cache_env_patches and not (self.minigeolifeclef and split == "test")
+
+    def _env_cache_path(self, split):
+        """Return the path of the environmental patches cache of a split.
+
+        The rasters and the patch size are part of the file name, so
+        that changing them does not re-use a stale cache.
+        """
+        rasters = "_".join(self.rasters)
+        return Path(self.dataset_path) / "rasters" / f"{self.dataset_cls.__name__}_{split}_{rasters}_size{self.patch_size}.npy"
+
+    def _patches_cache_dir(self, split):
+        """Return the directory of the memory-mapped patches of a split.
+
+        The modalities, rasters and patch size are part of the
+        directory name, so that changing them does not re-use a stale
+        cache.
+        """
+        modalities = "_".join(self.patch_data + list(self.rasters))
+        return Path(self.dataset_path) / "cache" / f"{self.dataset_cls.__name__}_{split}_{modalities}_size{self.patch_size}"
+
+    def prepare_data(self):
+        """Build the on-disk caches of the patches.
+
+        Called by the Trainer on a single process, before `setup` is
+        called on every process: the caches are thus written once and
+        only memory-mapped by the datasets.
+        """
+        for split in ("train", "val", "test"):
+            cache_path = self._env_cache_path(split)
+            if self._use_env_cache(split) and not cache_path.exists():
+                patch_extractor = self._get_patch_extractor()
+                dataset = self.dataset_cls(self.dataset_path, split, patch_data=self.patch_data, use_rasters=True,
+                                           patch_extractor=patch_extractor)
+                patch_extractor.prebake(dataset.coordinates, cache_path)
+            if self.in_memory and not self.minigeolifeclef:
+                # Writes the memory-mapped patches of the split
+                self.get_dataset(split, transform=None)
+
     def get_dataset(self, split, transform, **kwargs):
-        if self.minigeolifeclef:
-            dataset_cls = MiniGeoLifeCLEF2022Dataset
+        cache_path = self._env_cache_path(split)
+        if self._use_env_cache(split) and cache_path.exists():
+            patch_extractor = MemmapPatchExtractor(cache_path)
         else:
-            dataset_cls = GeoLifeCLEF2022Dataset
+            patch_extractor = self._get_patch_extractor()
 
-        patch_extractor = PatchExtractor(Path(self.dataset_path) / "rasters", size=20)
-        patch_extractor.append("bio_1", nan=-12.0)
-        patch_extractor.append("bio_2", nan=1.0)
-        patch_extractor.append("bio_7", nan=1.0)
-
-        dataset = dataset_cls(
+        dataset = self.dataset_cls(
             self.dataset_path,
             split,
-            patch_data=["rgb"],
+            patch_data=self.patch_data,
             use_rasters=True,
             patch_extractor=patch_extractor,
             transform=transform,
             **kwargs
         )
+
+        if self.in_memory:
+            cache_dir = None if self.minigeolifeclef else self._patches_cache_dir(split)
+            dataset.load_in_memory(cache_dir)
         return dataset
 
 
@@ -122,18 +177,131 @@ class CustomClassificationSystem(ClassificationSystem):
         cfg_optimizer: DictConfig,
         cfg_task: DictConfig,
         checkpoint_path: str = None,
+        feature_dim: int = None,
+        channels_last: bool = False,
     ):
         model = HomogeneousMultiModalModel(
             ["rgb", "temperature"],
             modalities_model,
-            torch.nn.LazyLinear(num_outputs),
+            torch.nn.Identity(),
+            modality_channels=[3, 3],
         )
+        if feature_dim is None:
+            # Dry run on fake data to infer the size of the concatenated features
+            x = torch.zeros(1, 3, 224, 224)
+            model.eval()
+            with torch.no_grad():
+                feature_dim = sum(m(x).shape[-1] for m in model.modality_models.values())
+            model.train()
+        model.aggregator_model = torch.nn.Linear(feature_dim, num_outputs)
+
+        super().__init__(model, **cfg_optimizer, **cfg_task, checkpoint_path=checkpoint_path,
+                         channels_last=channels_last)
+        # Normalization constants of the RGB and temperature channels, not saved in the checkpoints
+        self.register_buffer("mean", NORMALIZATION_MEAN, persistent=False)
+        self.register_buffer("std", NORMALIZATION_STD, persistent=False)
+
+    def on_after_batch_transfer(self, batch, dataloader_idx):
+        """Augment and normalize the batch on its device.
 
-        super().__init__(model, **cfg_optimizer, **cfg_task, checkpoint_path=checkpoint_path)
+        Called by the Trainer once the batch has been moved to the
+        model's device: the random rotations and flips of the training
+        batches (fused in a single resampling) and the normalization
+        then run once per batch on the GPU instead of once per sample
+        in the dataloader workers. The RGB and temperature channels are
+        kept stacked and split by the model itself.
+
+        This hook is defined on the model rather than on the datamodule
+        so that it also runs when the Trainer is only given dataloaders,
+        as in `ClassificationSystem.predict`.
+        """
+        x, y = batch
+        if self.trainer.training:
+            x = random_rotation_flip_batch(x, degrees=45, fill=1)
+        x = (x - self.mean.to(x.dtype)) / self.std.to(x.dtype)
+        return x, y
+
+
+class LinkBestModelCheckpoint(ModelCheckpoint):
+    """Checkpoint the latest training state, hardlinked when a metric improves.
+
+    The full training state (weights and optimizer) is written once per
+    save, as an unmonitored checkpoint replacing the previous one (and
+    linked by last.ckpt if `save_last="link"`). When `best_monitor`
+    improves, that same file is also hardlinked to `best_filename`: the
+    best checkpoint is a second name for the latest one, not a second
+    write, and it survives the removal of the latest checkpoint at the
+    next save.
+
+    The checkpoint filename must differ between saves (as the default
+    one does), otherwise the next save would overwrite the best
+    checkpoint through its hardlink.
+    """
+    def __init__(
+        self,
+        best_monitor: str,
+        best_mode: str = "max",
+        best_filename: str = "best.ckpt",
+        **kwargs: Any,
+    ):
+        """Class constructor.
+
+        Parameters
+        ----------
+        best_monitor : str
+            metric deciding which checkpoint is the best one
+        best_mode : str, optional
+            "max" or "min", whether `best_monitor` should be maximized
+            or minimized, by default "max"
+        best_filename : str, optional
+            name of the best checkpoint, in the same directory as the
+            latest one, by default "best.ckpt"
+        **kwargs : Any
+            arguments of ModelCheckpoint, except `monitor`
+        """
+        super().__init__(save_on_train_epoch_end=True, **kwargs)
+        self.best_monitor = best_monitor
+        self.best_mode = best_mode
+        self.best_filename = best_filename
+        self.best_monitor_score = None
+
+    def on_train_epoch_end(self, trainer: pl.Trainer, pl_module: pl.LightningModule) -> None:
+        """Save the latest checkpoint, then link it if the metric improved."""
+        latest_path, best_score = self.best_model_path, self.best_monitor_score
+        score = trainer.callback_metrics.get(self.best_monitor)
+        improved = score is not None and (
+            best_score is None or (score > best_score if self.best_mode == "max" else score < best_score)
+        )
+        if improved:
+            # Set before saving, for the score to be part of the saved state
+            self.best_monitor_score = float(score)
+        super().on_train_epoch_end(trainer, pl_module)
+        if self.best_model_path == latest_path:
+            # No checkpoint saved at this epoch (see `every_n_epochs`)
+            self.best_monitor_score = best_score
+        elif improved and trainer.is_global_zero:
+            best_path = os.path.join(os.path.dirname(self.best_model_path), self.best_filename)
+            tmp_path = best_path + ".tmp"
+            if os.path.lexists(tmp_path):
+                os.remove(tmp_path)
+            os.link(self.best_model_path, tmp_path)
+            os.replace(tmp_path, best_path)
+
+    def state_dict(self) -> dict[str, Any]:
+        """Return the state of the callback, with the best score."""
+        return {**super().state_dict(), "best_monitor_score": self.best_monitor_score}
+
+    def load_state_dict(self, state_dict: dict[str, Any]) -> None:
+        """Reload the state of the callback, with the best score."""
+        super().load_state_dict(state_dict)
+        self.best_monitor_score = state_dict.get("best_monitor_score")
 
 
 @hydra.main(version_base="1.3", config_path="config", config_name="homogeneous_multi_modal_model")
 def main(cfg: DictConfig) -> None:
+    # Enables TF32 tensor cores for float32 matmuls/convolutions on Ampere GPUs and newer
+    torch.set_float32_matmul_precision('high')
+
     # Loggers
     log_dir = hydra.core.hydra_config.HydraConfig.get().runtime.output_dir
     log_dir = log_dir.split(hydra.utils.get_original_cwd())[1][1:]  # Transforming absolute path to relative path
@@ -150,16 +318,20 @@ def main(cfg: DictConfig) -> None:
     # Lightning Trainer
     callbacks = [
         Summary(),
-        ModelCheckpoint(
+        LinkBestModelCheckpoint(
+            best_monitor="top_30_multiclass_accuracy/val",
+            best_mode="max",
             dirpath=log_dir,
-            filename="checkpoint-{epoch:02d}-{step}-{top_30_multiclass_accuracy/val:.4f}",
-            monitor="top_30_multiclass_accuracy/val",
-            mode="max",
-            save_on_train_epoch_end=True,
-            save_last=True,
+            filename="checkpoint-{epoch:02d}-{step}",
+            save_top_k=1,
+            save_last="link",
+            every_n_epochs=cfg.run.checkpoint_every_n_epochs,
         ),
     ]
-    trainer = pl.Trainer(logger=[logger_csv, logger_tb], callbacks=callbacks, **cfg.trainer)
+    trainer_kwargs = dict(cfg.trainer)
+    if trainer_kwargs.get('precision') is None and torch.cuda.is_available():
+        trainer_kwargs['precision'] = 'bf16-mixed' if torch.cuda.is_bf16_supported() else '16-mixed'
+    trainer = pl.Trainer(logger=[logger_csv, logger_tb], callbacks=callbacks, **trainer_kwargs)
 
     if cfg.run.predict:
         model_loaded = CustomClassificationSystem.load_from_checkpoint(classif_system.checkpoint_path,
@@ -175,6 +347,9 @@ def main(cfg: DictConfig) -> None:
                                       out_dir=log_dir, out_name='predictions_test_dataset', top_k=3, return_csv=True)
         print('Test dataset prediction (extract) : ', predictions[:1])
     else:
+        if cfg.run.compile:
+            # In-place compilation keeps the state_dict keys (and thus checkpoints) unchanged
+            classif_system.model.compile(mode='max-autotune')
         trainer.fit(classif_system, datamodule=datamodule)
         trainer.validate(classif_system, datamodule=datamodule)
 
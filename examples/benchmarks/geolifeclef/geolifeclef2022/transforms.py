@@ -7,21 +7,24 @@ Author: Titouan Lorieul <titouan.lorieul@gmail.com>
         Theo Larcher <theo.larcher@inria.fr>
 """
 
+import math
+
 import numpy as np
 import torch
-from torchvision import transforms
+import torch.nn.functional as F
+from torchvision.transforms import v2 as transforms
 
 
 class RGBDataTransform:
     def __call__(self, data):
-        return transforms.functional.to_tensor(data)
+        data = transforms.functional.to_image(data)
+        return transforms.functional.to_dtype(data, torch.float32, scale=True).as_subclass(torch.Tensor)
 
 
 class NIRDataTransform:
     def __call__(self, data):
         data = np.tile(data[:, :, None], 3)
-        data = transforms.functional.to_tensor(data)
-        return data
+        return RGBDataTransform()(data)
 
 
 class RasterDataTransform:
@@ -34,7 +37,7 @@ class RasterDataTransform:
         data = torch.as_tensor(data, dtype=torch.float32)
         data = (data - self.mu) / self.sigma
         if self.resize:
-            data = transforms.functional.resize(data, self.resize)
+            data = transforms.functional.resize(data, self.resize, antialias=True)
         return data
 
 
@@ -88,4 +91,49 @@ class PreprocessRGBTemperatureData:
         rgb_data = RGBDataTransform()(rgb_data)
         temp_data = TemperatureDataTransform()(temp_data)
 
-        return torch.concat((rgb_data, temp_data))
\ No newline at end of file
+        return torch.concat((rgb_data, temp_data))
+
+
+def random_rotation_flip_batch(x, degrees=45, fill=1.0, mode="nearest"):
+    """Randomly rotate and flip a batch of images in a single resampling.
+
+    Each image of the batch gets its own rotation angle, uniformly drawn
+    in `[-degrees, degrees]`, and random horizontal and vertical flips
+    with probability 0.5. Rotation and flips are fused into one affine
+    matrix per image, so the whole batch is resampled by a single
+    `grid_sample` call on the batch's device.
+
+    Parameters
+    ----------
+    x : torch.Tensor
+        batch of images of shape (N, C, H, W)
+    degrees : float, optional
+        range of the rotation angles, by default 45
+    fill : float, optional
+        value of the pixels outside of the rotated images, by default 1.0
+    mode : str, optional
+        interpolation mode passed on to `grid_sample`, by default "nearest"
+        (same as `RandomRotation`)
+
+    Returns
+    -------
+    torch.Tensor
+        augmented batch of images
+    """
+    n, _, h, w = x.shape
+    angle = (torch.rand(n, device=x.device) * 2 - 1) * math.radians(degrees)
+    flip_x = torch.randint(0, 2, (n,), device=x.device) * 2 - 1
+    flip_y = torch.randint(0, 2, (n,), device=x.device) * 2 - 1
+    cos, sin = torch.cos(angle), torch.sin(angle)
+
+    # Rotation in pixel space expressed in affine_grid's normalized coordinates
+    theta = torch.zeros(n, 2, 3, dtype=x.dtype, device=x.device)
+    theta[:, 0, 0] = cos * flip_x
+    theta[:, 0, 1] = -sin * flip_y * h / w
+    theta[:, 1, 0] = sin * flip_x * w / h
+    theta[:, 1, 1] = cos * flip_y
+
+    grid = F.affine_grid(theta, x.shape, align_corners=False)
+    # grid_sample pads with zeros, shift the values so that the padding equals `fill`
+    x = F.grid_sample(x - fill, grid, mode=mode, padding_mode="zeros", align_corners=False)
+    return x + fill
@@ -1,16 +1,28 @@
-from .data_module import BaseDataModule
-from .environmental_raster import PatchExtractor, Raster
+from .data_module import (BaseDataModule, CudaPrefetcher, IndexOnlyDataLoader,
+                          default_num_workers, tune_num_workers)
+from .environmental_raster import MemmapPatchExtractor, PatchExtractor, Raster
 from .get_jpeg_patches_stats import standardize
 from .utils import (get_files_path_recursively, is_bbox_contained,
-                    is_point_in_bbox, to_one_hot_encoding)
+                    is_bbox_contained_batch, is_point_in_bbox,
+                    iter_files_path_recursively, label_index_map,
+                    to_one_hot_encoding, to_one_hot_encoding_batch)
 
 __all__ = [
     "BaseDataModule",
+    "CudaPrefetcher",
+    "IndexOnlyDataLoader",
+    "default_num_workers",
+    "tune_num_workers",
+    "MemmapPatchExtractor",
     "PatchExtractor",
     "Raster",
     "standardize",
     "get_files_path_recursively",
     "is_bbox_contained",
+    "is_bbox_contained_batch",
     "is_point_in_bbox",
-    "to_one_hot_encoding"
+    "iter_files_path_recursively",
+    "label_index_map",
+    "to_one_hot_encoding",
+    "to_one_hot_encoding_batch",
 ]
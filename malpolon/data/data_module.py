@@ -6,6 +6,8 @@ Author: Theo Larcher <theo.larcher@inria.fr>
 
 from __future__ import annotations
 
+import os
+import time
 from abc import ABC, abstractmethod
 from pathlib import Path
 from typing import TYPE_CHECKING
@@ -14,15 +16,264 @@ import numpy as np
 import pandas as pd
 import pytorch_lightning as pl
 import torch
-from torch.utils.data import DataLoader
+from lightning_utilities.core.apply_func import apply_to_collection
+from omegaconf import OmegaConf
+from torch.utils.data import BatchSampler, DataLoader, SequentialSampler
 
 if TYPE_CHECKING:
-    from typing import Any, Callable, Optional, Union
+    from typing import Any, Callable, Iterable, Iterator, Optional, Union
 
     from torch import Tensor
     from torch.utils.data import Dataset
 
 
+def default_num_workers(max_workers: int = 8, world_size: Optional[int] = None) -> int:
+    """Return a default number of dataloader workers per process.
+
+    Data loading throughput plateaus (and can even decrease) beyond
+    4 to 8 workers, while each distributed process spawns its own
+    workers. The CPUs available to the process (its CPU affinity, when
+    supported) are thus shared between processes and the number of
+    workers is capped to `max_workers`.
+
+    Parameters
+    ----------
+    max_workers : int, optional
+        maximum number of workers, by default 8
+    world_size : Optional[int], optional
+        number of distributed processes, by default None (read from
+        torch.distributed if initialized, else from the `WORLD_SIZE`
+        environment variable)
+
+    Returns
+    -------
+    int
+        number of workers
+    """
+    if world_size is None and torch.distributed.is_available() and torch.distributed.is_initialized():
+        world_size = torch.distributed.get_world_size()
+    elif world_size is None:
+        world_size = int(os.environ.get('WORLD_SIZE', 1))
+    if hasattr(os, 'sched_getaffinity'):
+        # CPUs the process may run on, e.g. as restricted by SLURM
+        n_cpus = len(os.sched_getaffinity(0))
+    else:
+        n_cpus = os.cpu_count() or 1
+    return min(max_workers, max(1, n_cpus // max(1, world_size)))
+
+
+def tune_num_workers(
+    datamodule: BaseDataModule,
+    candidates: Iterable[int] = (0, 1, 2, 4, 8),
+    max_batches: Optional[int] = None,
+    log_dir: Optional[str] = None,
+) -> int:
+    """Select the fastest number of workers for a datamodule.
+
+    Iterates once over the train dataloader for each candidate number
+    of workers, then sets `datamodule.num_workers` to the fastest one.
+    If `log_dir` is given, the result is cached in
+    `<log_dir>/num_workers.yaml` and re-used on the next calls.
+
+    Parameters
+    ----------
+    datamodule : BaseDataModule
+        datamodule to tune. Its train dataset is set up if needed.
+    candidates : Iterable[int], optional
+        numbers of workers to try, by default (0, 1, 2, 4, 8)
+    max_batches : Optional[int], optional
+        maximum number of batches to load per candidate, by default
+        None (whole epoch)
+    log_dir : Optional[str], optional
+        directory in which to cache the result, by default None
+
+    Returns
+    -------
+    int
+        fastest number of workers
+    """
+    cache_path = Path(log_dir) / 'num_workers.yaml' if log_dir is not None else None
+    if cache_path is not None and cache_path.exists():
+        datamodule.num_workers = OmegaConf.load(cache_path).num_workers
+        return datamodule.num_workers
+
+    if datamodule.dataset_train is None:
+        datamodule.setup(stage='fit')
+    persistent_workers = datamodule.persistent_workers
+    datamodule.persistent_workers = False
+    throughputs = {}
+    for num_workers in candidates:
+        datamodule.num_workers = num_workers
+        start, n_batches = time.perf_counter(), 0
+        for n_batches, _ in enumerate(datamodule.train_dataloader(), start=1):
+            if max_batches is not None and n_batches >= max_batches:
+                break
+        throughputs[num_workers] = n_batches / (time.perf_counter() - start)
+        print(f'[INFO] num_workers={num_workers}: {throughputs[num_workers]:.2f} batches/s')
+    datamodule.persistent_workers = persistent_workers
+    datamodule.num_workers = max(throughputs, key=throughputs.get)
+
+    if cache_path is not None:
+        OmegaConf.save({'num_workers': datamodule.num_workers, 'batches_per_second': throughputs}, cache_path)
+    return datamodule.num_workers
+
+
+class CudaPrefetcher:
+    """Dataloader wrapper copying the next batch to the GPU in advance.
+
+    While the current batch is being processed, the next one is fetched
+    from the dataloader and copied to the GPU on a side CUDA stream, so
+    that host-to-device copies overlap with computations. Attributes
+    other than the ones defined here (e.g. `sampler`, `dataset`) are
+    looked up on the wrapped dataloader.
+
+    Memory should be pinned by the dataloader for the copies to be
+    asynchronous.
+    """
+    def __init__(
+        self,
+        loader: DataLoader,
+        device: Optional[Union[str, torch.device]] = None,
+    ):
+        """Class constructor.
+
+        Parameters
+        ----------
+        loader : DataLoader
+            dataloader to wrap
+        device : Optional[Union[str, torch.device]], optional
+            CUDA device to copy the batches to, by default None (current
+            CUDA device)
+        """
+        self.loader = loader
+        self.device = torch.device('cuda', torch.cuda.current_device()) if device is None else torch.device(device)
+        self.stream = torch.cuda.Stream(device=self.device)
+
+    def __getattr__(self, name: str) -> Any:
+        """Look up missing attributes on the wrapped dataloader."""
+        if name == 'loader':
+            raise AttributeError(name)
+        return getattr(self.loader, name)
+
+    def __len__(self) -> int:
+        """Return the number of batches of the wrapped dataloader."""
+        return len(self.loader)
+
+    def _preload(self, loader_iter: Iterator) -> Any:
+        try:
+            batch = next(loader_iter)
+        except StopIteration:
+            return None
+        with torch.cuda.stream(self.stream):
+            return apply_to_collection(batch, torch.Tensor, lambda t: t.to(self.device, non_blocking=True))
+
+    def __iter__(self) -> Iterator:
+        """Yield the batches on the GPU, the next one being copied in advance."""
+        loader_iter = iter(self.loader)
+        next_batch = self._preload(loader_iter)
+        while next_batch is not None:
+            current_stream = torch.cuda.current_stream(self.device)
+            current_stream.wait_stream(self.stream)
+            batch = next_batch
+            # Prevents the caching allocator from re-using the batch's memory before the current stream is done with it
+            apply_to_collection(batch, torch.Tensor, lambda t: t.record_stream(current_stream))
+            next_batch = self._preload(loader_iter)
+            yield batch
+
+
+class IndexOnlyDataLoader:
+    """Dataloader over a dataset held in GPU memory.
+
+    The samples of the dataset are loaded once, with their transforms
+    applied, and stored as tensors on the GPU. Batches are then views
+    of contiguous chunks of these tensors: no workers, no collation and
+    no host-to-device copies. Samples are iterated sequentially, which
+    makes this loader suited to inference (e.g. validation).
+    """
+    def __init__(
+        self,
+        dataset: Dataset,
+        tensors: tuple[Tensor, ...],
+        batch_size: int,
+    ):
+        """Class constructor.
+
+        Parameters
+        ----------
+        dataset : Dataset
+            dataset the tensors were loaded from
+        tensors : tuple[Tensor, ...]
+            elements of the samples (e.g. data and targets) stacked
+            along their first dimension
+        batch_size : int
+            number of samples per batch
+        """
+        self.dataset = dataset
+        self.tensors = tensors
+        self.batch_size = batch_size
+        self.sampler = SequentialSampler(dataset)
+        self.batch_sampler = BatchSampler(self.sampler, batch_size, drop_last=False)
+
+    @classmethod
+    def from_dataloader(
+        cls,
+        loader: DataLoader,
+        device: Union[str, torch.device],
+        max_memory_fraction: float = 0.5,
+    ) -> Optional[IndexOnlyDataLoader]:
+        """Load the whole dataset of a dataloader to the GPU.
+
+        The size of the dataset is estimated from the first batch and
+        compared with the free memory of the device beforehand.
+
+        Parameters
+        ----------
+        loader : DataLoader
+            sequential dataloader yielding tuples (or lists) of tensors
+        device : Union[str, torch.device]
+            CUDA device to load the dataset to
+        max_memory_fraction : float, optional
+            maximum fraction of the device's free memory the dataset
+            can occupy, by default 0.5
+
+        Returns
+        -------
+        Optional[IndexOnlyDataLoader]
+            GPU-resident dataloader, or None if the batches are not
+            tuples of tensors or if the dataset does not fit in memory
+        """
+        device = torch.device(device)
+        n_samples = len(loader.dataset)
+        tensors = None
+        start = 0
+        for batch in loader:
+            if tensors is None:
+                if not isinstance(batch, (tuple, list)) or not all(isinstance(t, torch.Tensor) for t in batch):
+                    return None
+                n_bytes = sum(t[0].nelement() * t.element_size() for t in batch) * n_samples
+                free_memory, _ = torch.cuda.mem_get_info(device)
+                if n_bytes > max_memory_fraction * free_memory:
+                    return None
+                tensors = tuple(torch.empty((n_samples, *t.shape[1:]), dtype=t.dtype, device=device) for t in batch)
+            end = start + len(batch[0])
+            for tensor, t in zip(tensors, batch):
+                tensor[start:end].copy_(t, non_blocking=True)
+            start = end
+        if tensors is None:
+            return None
+        return cls(loader.dataset, tensors, loader.batch_size)
+
+    def __len__(self) -> int:
+        """Return the number of batches."""
+        return len(self.batch_sampler)
+
+    def __iter__(self) -> Iterator:
+        """Yield the batches as views of the GPU-resident tensors."""
+        n_samples = len(self.tensors[0])
+        for start in range(0, n_samples, self.batch_size):
+            yield tuple(t[start:start + self.batch_size] for t in self.tensors)
+
+
 class BaseDataModule(pl.LightningDataModule, ABC):
     """Base class for data modules.
 
@@ -34,16 +285,25 @@ class BaseDataModule(pl.LightningDataModule, ABC):
         self,
         train_batch_size: int = 32,
         inference_batch_size: int = 256,
-        num_workers: int = 8,
+        num_workers: Optional[int] = 8,
+        persistent_workers: bool = True,
+        prefetch_factor: int = 4,
+        cuda_prefetch: bool = False,
+        val_on_gpu: bool = False,
     ):
         super().__init__()
 
         self.train_batch_size = train_batch_size
         self.inference_batch_size = inference_batch_size
         self.num_workers = num_workers
+        self.persistent_workers = persistent_workers
+        self.prefetch_factor = prefetch_factor
+        self.cuda_prefetch = cuda_prefetch
+        self.val_on_gpu = val_on_gpu
+        self._val_dataset_gpu = None
+        self._val_dataloader_gpu = None
 
-        # TODO check if uses GPU or not before using pin memory
-        self.pin_memory = True
+        self.pin_memory = torch.cuda.is_available()
 
         self.dataset_train = None
         self.dataset_val = None
@@ -165,38 +425,119 @@ class BaseDataModule(pl.LightningDataModule, ABC):
         permanent transformation...
         """
 
-    def train_dataloader(self) -> DataLoader:
+    def _dataloader_kwargs(self, persistent: bool = False) -> dict:
+        """Return the DataLoader arguments related to workers and memory.
+
+        When the trainer reloads its dataloaders every n epochs, workers
+        are re-spawned anyway: persistent workers and pinned memory are
+        then disabled, as that combination is known to crash.
+
+        If `self.num_workers` is None, a default number of workers is
+        computed here rather than at instantiation, once the trainer
+        (and its world size) is known.
+
+        Parameters
+        ----------
+        persistent : bool, optional
+            if True, keeps the workers alive between epochs (if
+            self.persistent_workers allows it), by default False
+
+        Returns
+        -------
+        dict
+            keyword arguments to pass on to the DataLoader
+        """
+        reload = self.trainer is not None and self.trainer.reload_dataloaders_every_n_epochs > 0
+        num_workers = self.num_workers
+        if num_workers is None:
+            num_workers = default_num_workers(world_size=self.trainer.world_size if self.trainer is not None else None)
+        kwargs = {
+            'num_workers': num_workers,
+            'pin_memory': self.pin_memory and not reload,
+        }
+        if num_workers > 0:
+            kwargs['persistent_workers'] = persistent and self.persistent_workers and not reload
+            kwargs['prefetch_factor'] = self.prefetch_factor
+        return kwargs
+
+    def _single_cuda_device(self) -> Optional[torch.device]:
+        """Return the CUDA device the data is loaded to, if it is the only one.
+
+        Data is only prefetched or held on a single CUDA device: in
+        distributed settings, the trainer needs raw DataLoaders to
+        inject its distributed sampler.
+
+        Returns
+        -------
+        Optional[torch.device]
+            CUDA device, or None if not training on a single CUDA device
+        """
+        if not torch.cuda.is_available():
+            return None
+        if self.trainer is None:
+            return torch.device('cuda', torch.cuda.current_device())
+        device = self.trainer.strategy.root_device
+        if device.type != 'cuda' or self.trainer.world_size > 1:
+            return None
+        return device
+
+    def train_dataloader(self) -> Union[DataLoader, CudaPrefetcher]:
         """Return train dataloader instantiated with class attributes.
 
+        If `self.cuda_prefetch` is True and training runs on a single
+        GPU, the dataloader is wrapped in a `CudaPrefetcher`.
+
         Returns
         -------
-        DataLoader
+        Union[DataLoader, CudaPrefetcher]
             train dataloader
         """
         dataloader = DataLoader(
             self.dataset_train,
             sampler=self.sampler,
             batch_size=self.train_batch_size,
-            num_workers=self.num_workers,
-            pin_memory=self.pin_memory,
+            **self._dataloader_kwargs(persistent=True),
             shuffle=True,
         )
+        device = self._single_cuda_device() if self.cuda_prefetch else None
+        if device is not None:
+            return CudaPrefetcher(dataloader, device)
         return dataloader
 
-    def val_dataloader(self) -> DataLoader:
+    def val_dataloader(self) -> Union[DataLoader, IndexOnlyDataLoader]:
         """Return validation dataloader instantiated with class attributes.
 
+        If `self.val_on_gpu` is True and the validation dataset fits in
+        the memory of the (single) GPU, it is loaded there once and an
+        `IndexOnlyDataLoader` is returned. Otherwise, falls back to a
+        regular DataLoader.
+
         Returns
         -------
-        DataLoader
+        Union[DataLoader, IndexOnlyDataLoader]
             Validation dataloader
         """
+        if self.val_on_gpu and self.sampler is None:
+            dataloader = self._val_dataloader_gpu
+            if self._val_dataset_gpu is not self.dataset_val:
+                dataloader = None
+                device = self._single_cuda_device()
+                if device is not None:
+                    dataloader = IndexOnlyDataLoader.from_dataloader(
+                        DataLoader(self.dataset_val, batch_size=self.inference_batch_size, **self._dataloader_kwargs()),
+                        device,
+                    )
+                    # Also caches failures (None), e.g. if the dataset does not fit in memory
+                    self._val_dataset_gpu = self.dataset_val
+                    self._val_dataloader_gpu = dataloader
+            if dataloader is not None:
+                return dataloader
+
         dataloader = DataLoader(
             self.dataset_val,
             sampler=self.sampler,
             batch_size=self.inference_batch_size,
-            num_workers=self.num_workers,
-            pin_memory=self.pin_memory,
+            **self._dataloader_kwargs(persistent=True),
         )
         return dataloader
 
@@ -212,8 +553,7 @@ class BaseDataModule(pl.LightningDataModule, ABC):
             self.dataset_test,
             sampler=self.sampler,
             batch_size=self.inference_batch_size,
-            num_workers=self.num_workers,
-            pin_memory=self.pin_memory,
+            **self._dataloader_kwargs(),
         )
         return dataloader
 
@@ -229,8 +569,7 @@ class BaseDataModule(pl.LightningDataModule, ABC):
             self.dataset_predict,
             sampler=self.sampler,
             batch_size=self.inference_batch_size,
-            num_workers=self.num_workers,
-            pin_memory=self.pin_memory,
+            **self._dataloader_kwargs(),
         )
         return dataloader
 
@@ -331,6 +331,7 @@ class GeoLifeCLEF2022Dataset(Dataset):
             self.targets = None
 
         self.patch_extractor: Optional[PatchExtractor] = None
+        self.cached_patches: Optional[dict[str, Patches]] = None
 
         if use_rasters:
             if patch_extractor is None:
@@ -402,6 +403,77 @@ class GeoLifeCLEF2022Dataset(Dataset):
 
         return df
 
+    def _load_patches(self, index: int) -> dict[str, Patches]:
+        """Load the patches of a dataset item from disk, before any transform.
+
+        Args:
+            index (int): dataset id.
+
+        Returns:
+            dict[str, Patches]: patches and environmental patches (if
+                rasters are used) corresponding to the dataset id.
+        """
+        latitude = self.coordinates[index][0]
+        longitude = self.coordinates[index][1]
+        observation_id = self.observation_ids[index]
+
+        patches = load_patch(observation_id, self.root, data=self.patch_data)
+
+        # Extracting patch from rasters
+        if self.patch_extractor is not None:
+            environmental_patches = self.patch_extractor[(latitude, longitude)]
+            patches["environmental_patches"] = environmental_patches
+
+        return patches
+
+    def load_in_memory(self, cache_dir: Optional[Union[str, Path]] = None) -> None:
+        """Load the patches of every observation at once.
+
+        The patches of each modality are stacked into a single array
+        of shape [n_observations, ...] from which items are then sliced,
+        sparing the decoding of images and raster extractions at each
+        epoch. Transforms are still applied per item.
+
+        If `cache_dir` is None, arrays are held in RAM, which is only
+        suitable for small datasets (e.g. MiniGeoLifeCLEF). Otherwise,
+        they are written once to `<cache_dir>/<modality>.npy` and
+        memory-mapped, letting the OS page cache keep hot samples in RAM.
+
+        Args:
+            cache_dir (str or pathlib.Path, optional): directory where to
+                store the stacked patches. Defaults to None (RAM).
+        """
+        first_patches = self._load_patches(0)
+        if cache_dir is not None:
+            cache_dir = Path(cache_dir)
+            cache_dir.mkdir(parents=True, exist_ok=True)
+            paths = {key: cache_dir / f"{key}.npy" for key in first_patches}
+            if all(path.exists() for path in paths.values()):
+                self.cached_patches = {key: np.load(path, mmap_mode="r") for key, path in paths.items()}
+                return
+            # Specific to each process so that concurrent calls do not corrupt each other
+            tmp_paths = {key: cache_dir / f"{key}.{os.getpid()}.tmp.npy" for key in first_patches}
+
+        cached_patches = {}
+        for key, patch in first_patches.items():
+            shape = (len(self),) + np.shape(patch)
+            if cache_dir is None:
+                cached_patches[key] = np.empty(shape, dtype=patch.dtype)
+            else:
+                cached_patches[key] = np.lib.format.open_memmap(tmp_paths[key], mode="w+",
+                                                                dtype=patch.dtype, shape=shape)
+        for index in range(len(self)):
+            patches = first_patches if index == 0 else self._load_patches(index)
+            for key, patch in patches.items():
+                cached_patches[key][index] = patch
+
+        if cache_dir is not None:
+            for key, values in cached_patches.items():
+                values.flush()
+                tmp_paths[key].replace(paths[key])
+            cached_patches = {key: np.load(path, mmap_mode="r") for key, path in paths.items()}
+        self.cached_patches = cached_patches
+
     def __len__(self) -> int:
         """Return the number of observations in the dataset."""
         return len(self.observation_ids)
@@ -421,14 +493,12 @@ class GeoLifeCLEF2022Dataset(Dataset):
         """
         latitude = self.coordinates[index][0]
         longitude = self.coordinates[index][1]
-        observation_id = self.observation_ids[index]
-
-        patches = load_patch(observation_id, self.root, data=self.patch_data)
 
-        # Extracting patch from rasters
-        if self.patch_extractor is not None:
-            environmental_patches = self.patch_extractor[(latitude, longitude)]
-            patches["environmental_patches"] = environmental_patches
+        if self.cached_patches is not None:
+            # Copies so that transforms can not alter the cache
+            patches = {key: np.array(values[index]) for key, values in self.cached_patches.items()}
+        else:
+            patches = self._load_patches(index)
 
         if self.use_localisation:
             patches["localisation"] = np.asarray(
@@ -399,8 +399,7 @@ class GLC24Datamodule(BaseDataModule):
         dataloader = DataLoader(
             self.dataset_val,
             batch_size=self.inference_batch_size,
-            num_workers=self.num_workers,
-            pin_memory=self.pin_memory,
+            **self._dataloader_kwargs(persistent=True),
             shuffle=True,
         )
         return dataloader
@@ -185,8 +185,7 @@ class ConcatTorchGeoDataModule(BaseDataModule):
         dataloader = DataLoader(
             self.dataset_train,
             batch_size=self.train_batch_size,
-            num_workers=self.num_workers,
-            pin_memory=self.pin_memory,
+            **self._dataloader_kwargs(persistent=True),
             shuffle=False,
         )
         return dataloader
@@ -195,8 +194,7 @@ class ConcatTorchGeoDataModule(BaseDataModule):
         dataloader = DataLoader(
             self.dataset_val,
             batch_size=self.inference_batch_size,
-            num_workers=self.num_workers,
-            pin_memory=self.pin_memory,
+            **self._dataloader_kwargs(persistent=True),
         )
         return dataloader
 
@@ -204,8 +202,7 @@ class ConcatTorchGeoDataModule(BaseDataModule):
         dataloader = DataLoader(
             self.dataset_test,
             batch_size=self.inference_batch_size,
-            num_workers=self.num_workers,
-            pin_memory=self.pin_memory,
+            **self._dataloader_kwargs(),
             shuffle=False,
         )
         return dataloader
@@ -214,8 +211,7 @@ class ConcatTorchGeoDataModule(BaseDataModule):
         dataloader = DataLoader(
             self.dataset_predict,
             batch_size=self.inference_batch_size,
-            num_workers=self.num_workers,
-            pin_memory=self.pin_memory,
+            **self._dataloader_kwargs(),
             shuffle=False,
         )
         return dataloader
@@ -6,7 +6,8 @@ from __future__ import annotations
 
 import math
 from pathlib import Path
-from typing import TYPE_CHECKING, Any, Callable, Dict, Sequence, Union
+from typing import (TYPE_CHECKING, Any, Callable, Dict, Optional, Sequence,
+                    Union)
 
 import numpy as np
 import pandas as pd
@@ -16,7 +17,8 @@ from pyproj import CRS, Transformer
 from torchgeo.datasets import BoundingBox, RasterDataset
 from torchgeo.samplers import Units
 
-from malpolon.data.utils import is_point_in_bbox, to_one_hot_encoding
+from malpolon.data.utils import (is_point_in_bbox, label_index_map,
+                                 to_one_hot_encoding)
 
 if TYPE_CHECKING:
     import numpy.typing as npt
@@ -142,6 +144,21 @@ class RasterTorchGeoDataset(RasterDataset):
     def __len__(self) -> int:
         return len(self.observation_ids)
 
+    @property
+    def unique_labels(self) -> Optional[np.ndarray]:
+        """All existing labels (species ids), sorted."""
+        return getattr(self, '_unique_labels', None)
+
+    @unique_labels.setter
+    def unique_labels(self, labels: np.ndarray) -> None:
+        self._unique_labels = labels
+        self._label_to_idx = None  # Built on first multilabel encoding
+
+    def _label_index_map(self) -> dict:
+        if self._label_to_idx is None:
+            self._label_to_idx = label_index_map(self.unique_labels)
+        return self._label_to_idx
+
     def _load_observation_data(
         self,
         root: Path = None,
@@ -397,7 +414,7 @@ class RasterTorchGeoDataset(RasterDataset):
         if self.task == 'classification_multiclass':
             return label[0]
         if self.task == 'classification_multilabel':
-            return to_one_hot_encoding(label, self.unique_labels)
+            return to_one_hot_encoding(label, self.unique_labels, self._label_index_map())
         return label
 
     def get_label(
@@ -144,8 +144,7 @@ class Sentinel2TorchGeoDataModule(BaseDataModule):
             self.dataset_train,
             sampler=self.sampler(self.dataset_train, size=self.size, units=self.units, crs=self.crs),
             batch_size=self.train_batch_size,
-            num_workers=self.num_workers,
-            pin_memory=self.pin_memory,
+            **self._dataloader_kwargs(persistent=True),
             shuffle=False,
         )
         return dataloader
@@ -155,8 +154,7 @@ class Sentinel2TorchGeoDataModule(BaseDataModule):
             self.dataset_val,
             sampler=self.sampler(self.dataset_val, size=self.size, units=self.units, crs=self.crs),
             batch_size=self.inference_batch_size,
-            num_workers=self.num_workers,
-            pin_memory=self.pin_memory,
+            **self._dataloader_kwargs(persistent=True),
         )
         return dataloader
 
@@ -165,8 +163,7 @@ class Sentinel2TorchGeoDataModule(BaseDataModule):
             self.dataset_test,
             sampler=self.sampler(self.dataset_test, size=self.size, units=self.units, crs=self.crs),
             batch_size=self.inference_batch_size,
-            num_workers=self.num_workers,
-            pin_memory=self.pin_memory,
+            **self._dataloader_kwargs(),
             shuffle=False,
         )
         return dataloader
@@ -176,8 +173,7 @@ class Sentinel2TorchGeoDataModule(BaseDataModule):
             self.dataset_predict,
             sampler=self.sampler(self.dataset_predict, size=self.size, units=self.units),
             batch_size=self.inference_batch_size,
-            num_workers=self.num_workers,
-            pin_memory=self.pin_memory,
+            **self._dataloader_kwargs(),
             shuffle=False,
         )
         return dataloader
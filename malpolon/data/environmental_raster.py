@@ -5,6 +5,7 @@ Author: Titouan Lorieul <titouan.lorieul@gmail.com>
 
 from __future__ import annotations
 
+import os
 import warnings
 from pathlib import Path
 from typing import TYPE_CHECKING, Any, Optional, Union
@@ -18,6 +19,7 @@ if TYPE_CHECKING:
 
     Coordinates = tuple[float, float]
     Patch = npt.NDArray[np.float32]
+    Points = npt.NDArray[np.float64]
 
 
 # fmt: off
@@ -317,6 +319,50 @@ class PatchExtractor():
         """
         return len(self.rasters_fr)
 
+    def prebake(
+        self,
+        points: Points,
+        out_path: Union[str, Path],
+        dtype: npt.DTypeLike = np.float16,
+    ) -> None:
+        """Extract the patches of a set of locations once and save them to disk.
+
+        The patches are stacked in a single array of shape
+        [n_points, n_rasters, size, size] (or [n_points, n_rasters] if
+        size == 1) saved as a `.npy` file, alongside the points
+        coordinates in `<out_path>.points.npy`. The resulting files can
+        then be memory-mapped by `MemmapPatchExtractor` instead of
+        loading the rasters.
+        Points are browsed in raster order (north to south, west to
+        east) to keep memory accesses local.
+
+        Parameters
+        ----------
+        points : 2d array of floats, [n_points, 2]
+            GPS coordinates (latitude, longitude) of the locations
+        out_path : string or pathlib.Path
+            Path of the `.npy` file to write the patches to.
+        dtype : numpy dtype
+            Data type of the saved patches, by default np.float16
+        """
+        out_path = Path(out_path)
+        # Temporary files are specific to each process so that concurrent calls do not corrupt each other
+        tmp_path = out_path.with_name(f"{out_path.stem}.{os.getpid()}.tmp.npy")
+        points_path = MemmapPatchExtractor.points_path(out_path)
+        tmp_points_path = points_path.with_name(f"{points_path.stem}.{os.getpid()}.tmp.npy")
+        points = np.asarray(points, dtype=np.float64)
+        patch_shape = self[tuple(points[0])].shape
+        patches = np.lib.format.open_memmap(tmp_path, mode="w+", dtype=dtype,
+                                            shape=(len(points),) + patch_shape)
+        for i in np.lexsort((points[:, 1], -points[:, 0])):
+            patches[i] = self[tuple(points[i])]
+        patches.flush()
+        del patches
+        np.save(tmp_points_path, points)
+        # Only expose complete files
+        tmp_points_path.replace(points_path)
+        tmp_path.replace(out_path)
+
     def plot(
         self,
         coordinates: Coordinates,
@@ -394,3 +440,66 @@ class PatchExtractor():
             return fig
 
         return None
+
+
+class MemmapPatchExtractor():
+    """Serves environmental patches pre-extracted by `PatchExtractor.prebake`.
+
+    The patches are memory-mapped rather than loaded, so that they are
+    read lazily and shared between dataloader workers through the OS
+    page cache. Only the locations given to `prebake` can be queried.
+
+    Parameters
+    ----------
+    path : string or pathlib.Path
+        Path to the `.npy` file written by `PatchExtractor.prebake`.
+    """
+
+    def __init__(self, path: Union[str, Path]):
+        self.path = Path(path)
+        self.patches = np.load(self.path, mmap_mode="r")
+        points = np.load(self.points_path(self.path))
+        self.index = {(lat, lon): i for i, (lat, lon) in enumerate(points.tolist())}
+
+    @staticmethod
+    def points_path(path: Union[str, Path]) -> Path:
+        """Return the path of the points coordinates file matching a patches file.
+
+        Parameters
+        ----------
+        path : string or pathlib.Path
+            Path to the patches `.npy` file.
+
+        Returns
+        -------
+        pathlib.Path
+            Path to the points coordinates `.npy` file.
+        """
+        path = Path(path)
+        return path.with_name(path.stem + ".points.npy")
+
+    def __getitem__(self, coordinates: Coordinates) -> npt.NDArray[np.float32]:
+        """Return the pre-extracted patches around the given GPS coordinates.
+
+        Parameters
+        ----------
+        coordinates : tuple containing two floats
+            GPS coordinates (latitude, longitude)
+
+        Returns
+        -------
+        patch : 3d array of floats, [n_rasters, size, size], or 1d array of floats, [n_rasters,], if size == 1
+            Pre-extracted patches around the given coordinates.
+        """
+        patch = self.patches[self.index[(float(coordinates[0]), float(coordinates[1]))]]
+        return np.array(patch, dtype=np.float32)
+
+    def __len__(self) -> int:
+        """Return the number of variables/rasters pre-extracted.
+
+        Returns
+        -------
+        n_rasters : integer
+            Number of pre-extracted rasters
+        """
+        return self.patches.shape[1]
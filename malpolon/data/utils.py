@@ -7,23 +7,25 @@ from __future__ import annotations
 
 import os
 import re
-from typing import Iterable, Union
+from importlib.util import find_spec
+from typing import Iterable, Iterator, Mapping, Optional, Union
 
 import numpy as np
 import pandas as pd
 from shapely import Point, Polygon
 from sklearn.preprocessing import LabelEncoder
 from torchgeo.datasets import BoundingBox
-from tqdm import tqdm
 from verde import train_test_split as spatial_tts
 
 from malpolon.plot.map import plot_observation_dataset as plot_od
 
+_REGEX_METACHARACTERS = frozenset('.^$*+?{}[]\\|()')
+
 
 def is_bbox_contained(
     bbox1: Union[Iterable, BoundingBox],
     bbox2: Union[Iterable, BoundingBox],
-    method: str = 'shapely'
+    method: str = 'manual'
 ) -> bool:
     """Determine if a 2D bbox in included inside of another.
 
@@ -42,7 +44,7 @@ def is_bbox_contained(
         Bounding box n°2.
     method : str
         Method to use for comparison. Can take any value in
-        ['shapely', 'manual', 'torchgeo'], by default 'shapely'.
+        ['shapely', 'manual', 'torchgeo'], by default 'manual'.
 
     Returns
     -------
@@ -50,10 +52,8 @@ def is_bbox_contained(
         True if bbox1 ⊂ bbox2, False otherwise.
     """
     if method == "manual":
-        is_contained = (bbox1[0] >= bbox2[0] and bbox1[0] <= bbox2[2]
-                        and bbox1[2] >= bbox2[0] and bbox1[2] <= bbox2[2]
-                        and bbox1[1] >= bbox2[1] and bbox1[1] <= bbox2[3]
-                        and bbox1[3] >= bbox2[1] and bbox1[3] <= bbox2[3])
+        is_contained = ((bbox2[0] <= bbox1[0]) & (bbox1[2] <= bbox2[2])
+                        & (bbox2[1] <= bbox1[1]) & (bbox1[3] <= bbox2[3]))
     elif method == "shapely":
         polygon1 = Polygon([(bbox1[0], bbox1[1]), (bbox1[0], bbox1[3]),
                             (bbox1[2], bbox1[3]), (bbox1[2], bbox1[1])])
@@ -65,10 +65,36 @@ def is_bbox_contained(
     return is_contained
 
 
+def is_bbox_contained_batch(
+    bboxes1: np.ndarray,
+    bbox2: Iterable,
+) -> np.ndarray:
+    """Determine which 2D bboxes of an array are included inside of another.
+
+    Vectorized version of `is_bbox_contained` (method 'manual').
+    Bounding boxes must follow the format: [xmin, ymin, xmax, ymax].
+
+    Parameters
+    ----------
+    bboxes1 : np.ndarray
+        Bounding boxes, of shape (N, 4).
+    bbox2 : Iterable
+        Bounding box in which to test the inclusion.
+
+    Returns
+    -------
+    np.ndarray
+        Boolean array of shape (N,), True where bboxes1[i] ⊂ bbox2.
+    """
+    bboxes1 = np.asarray(bboxes1)
+    return (np.less_equal(bbox2[0], bboxes1[:, 0]) & np.less_equal(bboxes1[:, 2], bbox2[2])
+            & np.less_equal(bbox2[1], bboxes1[:, 1]) & np.less_equal(bboxes1[:, 3], bbox2[3]))
+
+
 def is_point_in_bbox(
     point: Iterable,
     bbox: Iterable,
-    method: str = 'shapely'
+    method: str = 'manual'
 ) -> bool:
     """Determine if a 2D point in included inside of a 2D bounding box.
 
@@ -76,6 +102,8 @@ def is_point_in_bbox(
     bbox ?".
     Point must follow the format: [x, y]
     Bounding box must follow the format: [xmin, ymin, xmax, ymax]
+    With method 'manual', points lying on the bbox's border are
+    considered inside; with method 'shapely' they are not.
 
     Parameters
     ----------
@@ -85,7 +113,7 @@ def is_point_in_bbox(
         Bounding box in the format [xmin, xmax, ymin, ymax].
     method : str
         Method to use for comparison. Can take any value in
-        ['shapely', 'manual'], by default 'shapely'.
+        ['shapely', 'manual'], by default 'manual'.
 
     Returns
     -------
@@ -93,8 +121,8 @@ def is_point_in_bbox(
         True if point ⊂ bbox, False otherwise.
     """
     if method == "manual":
-        is_contained = (point[0] >= bbox[0] and point[0] <= bbox[2]
-                        and point[1] >= bbox[1] and point[1] <= bbox[3])
+        is_contained = ((bbox[0] <= point[0]) & (point[0] <= bbox[2])
+                        & (bbox[1] <= point[1]) & (point[1] <= bbox[3]))
     elif method == "shapely":
         point = Point(point)
         polygon2 = Polygon([(bbox[0], bbox[1]), (bbox[0], bbox[3]),
@@ -103,15 +131,38 @@ def is_point_in_bbox(
     return is_contained
 
 
+def label_index_map(labels_target: Iterable) -> dict:
+    """Return a mapping from each label to its index in labels_target.
+
+    Build it once per set of labels and pass it on to
+    `to_one_hot_encoding` or `to_one_hot_encoding_batch` to encode
+    labels in O(number of predicted labels).
+
+    Parameters
+    ----------
+    labels_target : Iterable
+        All existing labels, in the right order.
+
+    Returns
+    -------
+    dict
+        Mapping from each label to its index.
+    """
+    labels_target = labels_target.tolist() if isinstance(labels_target, np.ndarray) else labels_target
+    return {label: idx for idx, label in enumerate(labels_target)}
+
+
 def to_one_hot_encoding(
     labels_predict: int | list,
     labels_target: list,
+    label_to_idx: Optional[Mapping] = None,
 ) -> list:
     """Return a one-hot encoding of class-index predicted labels.
 
     Converts a single label value or a vector of labels into a vector
     of one-hot encoded labels. The labels order follow that of input
-    labels_target.
+    labels_target. Predicted labels absent from labels_target are
+    ignored.
 
     Parameters
     ----------
@@ -119,19 +170,122 @@ def to_one_hot_encoding(
         Labels to convert to one-hot encoding.
     labels_target : list
         All existing labels, in the right order.
+    label_to_idx : Optional[Mapping], optional
+        mapping from each label to its index in labels_target, as
+        returned by `label_index_map`, by default None (labels_target
+        is scanned)
 
     Returns
     -------
     list
         One-hot encoded labels.
     """
-    labels_predict = [labels_predict] if isinstance(labels_predict, int) else labels_predict
-    n_classes = len(labels_target)
-    one_hot_labels = np.zeros(n_classes, dtype=np.float32)
-    one_hot_labels[np.in1d(labels_target, labels_predict)] = 1
+    labels_predict = [labels_predict] if np.ndim(labels_predict) == 0 else labels_predict
+    if label_to_idx is None:
+        one_hot_labels = np.zeros(len(labels_target), dtype=np.float32)
+        one_hot_labels[np.isin(labels_target, labels_predict)] = 1
+        return one_hot_labels
+    labels_predict = labels_predict.tolist() if isinstance(labels_predict, np.ndarray) else labels_predict
+    one_hot_labels = np.zeros(len(label_to_idx), dtype=np.float32)
+    idx = [label_to_idx[label] for label in labels_predict if label in label_to_idx]
+    one_hot_labels[idx] = 1
     return one_hot_labels
 
 
+def to_one_hot_encoding_batch(
+    labels_predict: np.ndarray,
+    labels_target: list,
+    label_to_idx: Optional[Mapping] = None,
+) -> np.ndarray:
+    """Return a one-hot encoding of a batch of class-index labels.
+
+    Batched version of `to_one_hot_encoding`: each row of
+    labels_predict is converted into a vector of one-hot encoded
+    labels in a single vectorized assignment.
+
+    Parameters
+    ----------
+    labels_predict : np.ndarray
+        Labels to convert to one-hot encoding, of shape (N, K).
+        Labels absent from labels_target are ignored.
+    labels_target : list
+        All existing labels, in the right order.
+    label_to_idx : Optional[Mapping], optional
+        mapping from each label to its index in labels_target, as
+        returned by `label_index_map`, by default None (built from
+        labels_target)
+
+    Returns
+    -------
+    np.ndarray
+        One-hot encoded labels of shape (N, len(labels_target)).
+    """
+    labels_predict = np.asarray(labels_predict)
+    labels_predict = labels_predict.reshape(len(labels_predict), -1)
+    label_to_idx = label_index_map(labels_target) if label_to_idx is None else label_to_idx
+    one_hot_labels = np.zeros((len(labels_predict), len(label_to_idx)), dtype=np.float32)
+    cols = np.fromiter((label_to_idx.get(label, -1) for label in labels_predict.ravel().tolist()),
+                       dtype=np.intp, count=labels_predict.size)
+    rows = np.repeat(np.arange(len(labels_predict)), labels_predict.shape[1])
+    valid = cols >= 0
+    one_hot_labels[rows[valid], cols[valid]] = 1
+    return one_hot_labels
+
+
+def iter_files_path_recursively(path, *args, suffix='') -> Iterator[str]:
+    """Iterate over specific files path recursively from a directory.
+
+    Generator version of `get_files_path_recursively`, useful to avoid
+    holding every path in memory when browsing very large directories.
+    Directories are browsed with `os.scandir` and symbolic links to
+    directories are not followed. File names are matched with
+    `str.endswith`, unless `suffix` or the extensions contain regular
+    expression metacharacters (e.g. 'tiff?').
+
+    Parameters
+    ----------
+    path : str
+        root directory from which to search for files recursively
+    *args : list
+        list of file extensions to be considered.
+    suffix : str, optional
+        pattern (regular expression) the file names must end with
+        (before the extension), by default ''
+
+    Yields
+    ------
+    str
+        path of a matching file.
+    """
+    exts = tuple(ext[1:] if ext[0] == '.' else ext for ext in args)
+    literal_exts = _REGEX_METACHARACTERS.isdisjoint(''.join(exts))
+    if literal_exts and _REGEX_METACHARACTERS.isdisjoint(suffix):
+        # Literal suffix: file names are fully matched by their endings
+        ends = tuple(f'{suffix}.{ext}' for ext in exts)
+        pattern = None
+    else:
+        # Extensions are only used as a prefilter if they are literal
+        ends = tuple(f'.{ext}' for ext in exts) if literal_exts else None
+        ext_list = "|".join(exts)
+        pattern = re.compile(rf"^.*({suffix})\.({ext_list})$")
+    dirs = [path]
+    while dirs:
+        try:
+            entries = os.scandir(dirs.pop())
+        except OSError:
+            continue
+        subdirs = []
+        with entries:
+            for entry in entries:
+                if entry.is_dir():
+                    if not entry.is_symlink():
+                        subdirs.append(entry.path)
+                elif ((ends is None or entry.name.endswith(ends))
+                      and (pattern is None or pattern.match(entry.name))):
+                    yield entry.path
+        dirs.extend(reversed(subdirs))
+
+
 def get_files_path_recursively(path, *args, suffix='') -> list:
     """Retrieve specific files path recursively from a directory.
 
@@ -152,23 +306,19 @@ def get_files_path_recursively(path, *args, suffix='') -> list:
     list list of paths of every file in the directory and all its
          subdirectories.
     """
-    exts = list(args)
-    for ext_i, ext in enumerate(exts):
-        exts[ext_i] = ext[1:] if ext[0] == '.' else ext
-    ext_list = "|".join(exts)
-    result = [os.path.join(dp, f)
-              for dp, dn, filenames in os.walk(path)
-              for f in filenames
-              if re.search(rf"^.*({suffix})\.({ext_list})$", f)]
-    return result
+    return list(iter_files_path_recursively(path, *args, suffix=suffix))
 
 
 def split_obs_spatially(input_path: str,
                         spacing: float = 10 / 60,
                         plot: bool = False,
-                        val_size: float = 0.15):
+                        val_size: float = 0.15,
+                        out_format: str = 'csv'):
     """Perform a spatial train/val split on the input csv file.
 
+    The input CSV is read with pandas' pyarrow engine if pyarrow is
+    installed, and with the default C engine otherwise.
+
     Parameters
     ----------
     input_path : str
@@ -181,34 +331,34 @@ def split_obs_spatially(input_path: str,
         by default False
     val_size : float, optional
         size of the validation split, by default 0.15
+    out_format : str, optional
+        format of the output files. Can take any value in
+        ['csv', 'parquet'] ('parquet' requires pyarrow), by default 'csv'
     """
+    if out_format not in ('csv', 'parquet'):
+        raise ValueError(f"Unsupported output format '{out_format}'. Choose 'csv' or 'parquet'.")
     input_name = input_path[:-4] if input_path.endswith(".csv") else input_path
-    df = pd.read_csv(f'{input_name}.csv')
-    coords, data = {}, {}
-    for col in df.columns:
-        if col in ['lon', 'lat']:
-            coords[col] = df[col].to_numpy()
-        else:
-            data[col] = df[col].to_numpy()
-    train_split, val_split = spatial_tts(tuple(coords.values()), tuple(data.values()),
+    engine = 'pyarrow' if find_spec('pyarrow') is not None else None
+    df = pd.read_csv(f'{input_name}.csv', engine=engine)
+    data_cols = [col for col in df.columns if col not in ['lon', 'lat']]
+    train_split, val_split = spatial_tts((df['lon'].to_numpy(), df['lat'].to_numpy()),
+                                         tuple(df[col].to_numpy() for col in data_cols),
                                          spacing=spacing, test_size=val_size)
+    del df
 
-    df_train = pd.DataFrame({'lon': train_split[0][0], 'lat': train_split[0][1]})
-    df_val = pd.DataFrame({'lon': val_split[0][0], 'lat': val_split[0][1]})
-    df_train['subset'] = ['train'] * len(df_train)
-    df_val['subset'] = ['val'] * len(df_val)
-    for train_data, val_data, col in zip(train_split[1], val_split[1], data.keys()):
-        df_train[col] = train_data
-        df_val[col] = val_data
-
+    df_train = pd.DataFrame({'lon': train_split[0][0], 'lat': train_split[0][1], 'subset': 'train',
+                             **dict(zip(data_cols, train_split[1]))})
+    df_val = pd.DataFrame({'lon': val_split[0][0], 'lat': val_split[0][1], 'subset': 'val',
+                           **dict(zip(data_cols, val_split[1]))})
     df_train_val = pd.concat([df_train, df_val])
 
-    df_train_val.to_csv(f'{input_name}_train_val-{spacing*60}min.csv', index=False)
-    print(f'Done: {input_name}_train_val-{spacing*60}min.csv')
-    df_train.to_csv(f'{input_name}_train-{spacing*60}min.csv', index=False)
-    print(f'Done: {input_name}_train-{spacing*60}min.csv')
-    df_val.to_csv(f'{input_name}_val-{spacing*60}min.csv', index=False)
-    print(f'Done: {input_name}_val-{spacing*60}min.csv')
+    for df_out, name in [(df_train_val, 'train_val'), (df_train, 'train'), (df_val, 'val')]:
+        fp = f'{input_name}_{name}-{spacing*60}min.{out_format}'
+        if out_format == 'parquet':
+            df_out.to_parquet(fp, index=False)
+        else:
+            df_out.to_csv(fp, index=False)
+        print(f'Done: {fp}')
 
     if plot:
         plot_od(df=df_train_val, show_map=True)
@@ -255,29 +405,26 @@ def split_obs_per_species_frequency(input_path: str,
     label_encoder = LabelEncoder().fit(pa_train[filter_id])
     pa_train[filter_id] = label_encoder.transform(pa_train[filter_id])
 
-    pa_train_uniques = np.unique(pa_train[filter_id], return_counts=True)
-    args_sorted = np.argsort(pa_train_uniques[1])
-    u_cls_sorted_desc = (pa_train_uniques[0][args_sorted][::-1],
-                         pa_train_uniques[1][args_sorted][::-1])
-
-    # Compute the number of classes which do not have enough occurrences to be split by given ratio into an integer value
-    indivisible_sid_n_rows = np.sum(u_cls_sorted_desc[1][u_cls_sorted_desc[1] < (1 / val_ratio)])
-    pa_val = pd.DataFrame(columns=pa_train.columns)
-    for sid, n_sid in zip(tqdm(u_cls_sorted_desc[0]), u_cls_sorted_desc[1]):
-        # Rare occurrences are excluded from the val split and kept in train (or kept if keep_rares > 0)
-        if n_sid >= (1 / val_ratio):
-            df_slice = pa_train[pa_train[filter_id] == sid]
-            pa_val = pd.concat([pa_val, df_slice.sample(n=round(n_sid * val_ratio))])
-        elif keep_rares and n_sid > keep_rares:
-            df_slice = pa_train[pa_train[filter_id] == sid]
-            pa_val = pd.concat([pa_val, df_slice.sample(n=keep_rares)])
-
-    pa_val['subset'] = ['val'] * len(pa_val)
+    # Number of occurrences to put in val for each class (0 for rare classes unless keep_rares > 0)
+    counts = pa_train[filter_id].value_counts()
+    rare = counts < (1 / val_ratio)
+    indivisible_sid_n_rows = counts[rare].sum()
+    n_val = (counts * val_ratio).round().astype(int).where(~rare, 0)
+    if keep_rares:
+        n_val = n_val.mask(rare & (counts > keep_rares), keep_rares)
+
+    # Shuffle once, then keep the first n_val rows of each class
+    pa_train_shuffled = pa_train.sample(frac=1)
+    rank_in_class = pa_train_shuffled.groupby(filter_id).cumcount().to_numpy()
+    val_mask = rank_in_class < pa_train_shuffled[filter_id].map(n_val).to_numpy()
+    pa_val = pa_train_shuffled[val_mask].sort_index()
+
+    pa_val['subset'] = 'val'
     pa_train = pa_train.drop(pa_val.index)
 
     # Restore original filter_id values
     pa_train[filter_id] = label_encoder.inverse_transform(pa_train[filter_id])
-    pa_val[filter_id] = label_encoder.inverse_transform(list(pa_val[filter_id].values))
+    pa_val[filter_id] = label_encoder.inverse_transform(pa_val[filter_id])
     pa_train_val = pd.concat([pa_train, pa_val])
 
     pa_train.to_csv(f'{output_name}_split-{val_ratio*100}%_train.csv', index=False)
@@ -285,8 +432,8 @@ def split_obs_per_species_frequency(input_path: str,
     pa_train_val.to_csv(f'{output_name}_split-{val_ratio*100}%_all.csv', index=False)
     print('Exported train_without_val, val, and train_val_split_by_species_frequency csvs.')
 
-    rare_cls = label_encoder.inverse_transform(u_cls_sorted_desc[0])[np.where(u_cls_sorted_desc[1] < (1 / val_ratio))]
-    rare_cls_counts = u_cls_sorted_desc[1][np.where(u_cls_sorted_desc[1] < (1 / val_ratio))]
+    rare_cls = label_encoder.inverse_transform(counts.index[rare])
+    rare_cls_counts = counts[rare].to_numpy()
     print(f'Rare classes were detected in the dataset: {dict(zip(rare_cls, rare_cls_counts))}')
     if keep_rares:
         print(f'{keep_rares} occurrences of rare classes have been included in val (if they contain at least {keep_rares + 1} occurrences).')
@@ -31,6 +31,7 @@ class MultiModalModel(nn.Module):
         self,
         modality_models: Union[nn.Module, Mapping],
         aggregator_model: Union[nn.Module, Mapping],
+        channels_last: bool = False,
     ):
         """Class constructor.
 
@@ -45,8 +46,13 @@ class MultiModalModel(nn.Module):
             module will be directly called), or a mapping in the same
             fashion as for buiding the modality models, in which case
             the model builder will be called again.
+        channels_last : bool, optional
+            if True, converts each 4D modality input to channels-last
+            memory format before passing it on to its model, by default
+            False
         """
         super().__init__()
+        self.channels_last = channels_last
 
         for modality_name, model in modality_models.items():
             modality_models[modality_name] = check_model(model)
@@ -58,7 +64,11 @@ class MultiModalModel(nn.Module):
         features = []
 
         for modality_name, model in self.modality_models.items():
-            out = model(x[modality_name])
+            x_modality = x[modality_name]
+            if self.channels_last and isinstance(x_modality, torch.Tensor) and x_modality.ndim == 4:
+                # Converted per modality: slices of a channels-last tensor are not channels-last contiguous
+                x_modality = x_modality.contiguous(memory_format=torch.channels_last)
+            out = model(x_modality)
             out = out.to(next(self.aggregator_model.parameters()).device)
             features.append(out)
 
@@ -67,12 +77,19 @@ class MultiModalModel(nn.Module):
 
 
 class HomogeneousMultiModalModel(MultiModalModel):
-    """Straightforward multi-modal model."""
+    """Straightforward multi-modal model.
+
+    The modalities can either be passed on as a dictionary or stacked
+    along the channel dimension of a single tensor, in which case they
+    are split on the tensor's device before each forward pass.
+    """
     def __init__(
         self,
         modality_names: list,
         modalities_model: dict,
         aggregator_model: Union[nn.Module, Mapping],
+        modality_channels: Optional[list[int]] = None,
+        channels_last: bool = False,
     ):
         """Class constructor.
 
@@ -89,14 +106,31 @@ class HomogeneousMultiModalModel(MultiModalModel):
             module will be directly called), or a mapping in the same
             fashion as for buiding the modality models, in which case
             the model builder will be called again.
+        modality_channels : Optional[list[int]]
+            number of channels of each modality when the input is a
+            single stacked tensor, by default None (channels evenly
+            split between the modalities)
+        channels_last : bool, optional
+            if True, converts each modality input to channels-last
+            memory format once split, by default False
         """
         self.modality_names = modality_names
         self.modalities_model = modalities_model
+        self.modality_channels = modality_channels
 
         modalities_models = {
             modality_name: dict(modalities_model) for modality_name in modality_names
         }
-        super().__init__(modalities_models, aggregator_model)
+        super().__init__(modalities_models, aggregator_model, channels_last=channels_last)
+
+    def forward(self, x: Union[torch.Tensor, Mapping[str, Any]]) -> Any:
+        if isinstance(x, torch.Tensor):
+            if self.modality_channels is None:
+                x = torch.tensor_split(x, len(self.modality_names), dim=1)
+            else:
+                x = torch.split(x, self.modality_channels, dim=1)
+            x = dict(zip(self.modality_names, x))
+        return super().forward(x)
 
 
 class ParallelMultiModalModelStrategy(SingleDeviceStrategy):
@@ -6,17 +6,20 @@ Author: Titouan Lorieul <titouan.lorieul@gmail.com>
 
 from __future__ import annotations
 
+from contextlib import nullcontext
 from pathlib import Path
 from typing import TYPE_CHECKING
 
 import pytorch_lightning as pl
 import torch
 import torchmetrics.functional as Fmetrics
+from lightning_utilities.core.apply_func import apply_to_collection
 from torchvision.datasets.utils import (download_and_extract_archive,
                                         download_url)
 
 from malpolon.models.utils import check_metric
 
+from .custom_models.multi_modal import MultiModalModel
 from .utils import check_loss, check_model, check_optimizer, check_scheduler
 
 if TYPE_CHECKING:
@@ -159,7 +162,15 @@ class GenericPredictionSystem(pl.LightningModule):
         x, y = batch
         y_hat = self(x)
 
-        loss = self.loss(y_hat, self._cast_type_to_loss(y))  # Shape mismatch for binary: need to 'y = y.unsqueeze(1)' (or use .reshape(2)) to cast from [2] to [2,1] and cast y to float with .float()
+        # The loss is computed in full precision, even under mixed precision
+        # (autocast only supports some device types, e.g. not MPS with torch 2.2)
+        y_hat_loss = y_hat.float() if y_hat.dtype in (torch.float16, torch.bfloat16) else y_hat
+        if y_hat.device.type in ('cuda', 'cpu'):
+            autocast_off = torch.autocast(device_type=y_hat.device.type, enabled=False)
+        else:
+            autocast_off = nullcontext()
+        with autocast_off:
+            loss = self.loss(y_hat_loss, self._cast_type_to_loss(y))  # Shape mismatch for binary: need to 'y = y.unsqueeze(1)' (or use .reshape(2)) to cast from [2] to [2,1] and cast y to float with .float()
         self.log(f"loss/{split}", loss, **log_kwargs)
 
         for metric_name, metric_func in self.metrics.items():
@@ -383,7 +394,8 @@ class ClassificationSystem(GenericPredictionSystem):
         task: str = 'classification_binary',
         loss_kwargs: Optional[dict] = {},
         hparams_preprocess: bool = True,
-        checkpoint_path: Optional[str] = None
+        checkpoint_path: Optional[str] = None,
+        channels_last: bool = False,
     ):
         """Class constructor.
 
@@ -414,6 +426,12 @@ class ClassificationSystem(GenericPredictionSystem):
         hparams_preprocess : bool, optional
             if True performs preprocessing operations on the hyperparameters,
             by default True
+        channels_last : bool, optional
+            if True, stores the model's weights and 4D inputs in
+            channels-last memory format, which is faster for
+            convolutional networks on recent GPUs (tensor cores),
+            by default False. Multi-modal models convert the inputs
+            of each modality themselves, once split.
         """
         if hparams_preprocess:
             task = task.split('classification_')[1]
@@ -425,7 +443,12 @@ class ClassificationSystem(GenericPredictionSystem):
         self.nesterov = nesterov
 
         self.checkpoint_path = checkpoint_path
+        self.channels_last = channels_last
         model = check_model(model)
+        if channels_last:
+            model = model.to(memory_format=torch.channels_last)
+            if isinstance(model, MultiModalModel):
+                model.channels_last = True
 
         if optimizer is None:
             print(f'[INFO] No optimizer provided: using SGD with lr={lr}, weight_decay={weight_decay}, momentum={momentum}, nesterov={nesterov}')
@@ -450,6 +473,11 @@ class ClassificationSystem(GenericPredictionSystem):
 
         super().__init__(model, loss, optimizer, metrics=metrics)
 
+    def forward(self, x: Any) -> Any:
+        if self.channels_last and not isinstance(self.model, MultiModalModel):
+            x = apply_to_collection(x, torch.Tensor, lambda t: t.contiguous(memory_format=torch.channels_last) if t.ndim == 4 else t)
+        return self.model(x)
+
 
 class RegressionSystem(GenericPredictionSystem):
     """Regression task class."""
@@ -0,0 +1,31 @@
+"""This module defines the fixtures shared by the tests."""
+
+import pytest
+import torch
+from torch.utils.data import TensorDataset
+
+from malpolon.data.data_module import BaseDataModule
+
+
+class _TensorDataModule(BaseDataModule):
+    def __init__(self, x=None, y=None, **kwargs):
+        super().__init__(train_batch_size=4, inference_batch_size=4, **kwargs)
+        self.x = torch.rand(10, 2) if x is None else x
+        self.y = torch.arange(len(self.x)) if y is None else y
+
+    @property
+    def train_transform(self):
+        return None
+
+    @property
+    def test_transform(self):
+        return None
+
+    def get_dataset(self, split, transform, **kwargs):
+        return TensorDataset(self.x, self.y)
+
+
+@pytest.fixture
+def tensor_datamodule():
+    """Return a data module class serving the same tensors for every split."""
+    return _TensorDataModule
@@ -0,0 +1,108 @@
+"""This script tests the base data module and its dataloader helpers."""
+
+import os
+from types import SimpleNamespace
+
+import pytest
+import torch
+from torch.utils.data import DataLoader, TensorDataset
+
+from malpolon.data.data_module import (CudaPrefetcher, IndexOnlyDataLoader,
+                                       default_num_workers, tune_num_workers)
+
+
+def test_default_num_workers(monkeypatch) -> None:
+    monkeypatch.setattr(os, 'sched_getaffinity', lambda pid: set(range(16)), raising=False)
+    monkeypatch.setenv('WORLD_SIZE', '1')
+    assert default_num_workers() == 8
+    assert default_num_workers(max_workers=32) == 16
+    monkeypatch.setenv('WORLD_SIZE', '4')
+    assert default_num_workers() == 4
+    monkeypatch.setenv('WORLD_SIZE', '32')
+    assert default_num_workers() == 1
+
+
+def test_dataloader_kwargs(tensor_datamodule) -> None:
+    datamodule = tensor_datamodule(num_workers=0)
+    datamodule.pin_memory = True
+    assert datamodule._dataloader_kwargs(persistent=True) == {'num_workers': 0, 'pin_memory': True}
+
+    datamodule.num_workers = 2
+    kwargs = datamodule._dataloader_kwargs(persistent=True)
+    assert kwargs['persistent_workers'] and kwargs['pin_memory']
+    assert kwargs['prefetch_factor'] == datamodule.prefetch_factor
+    assert not datamodule._dataloader_kwargs()['persistent_workers']
+
+    # Reloading dataloaders disables persistent workers and pinned memory
+    datamodule.trainer = SimpleNamespace(reload_dataloaders_every_n_epochs=1)
+    kwargs = datamodule._dataloader_kwargs(persistent=True)
+    assert not kwargs['persistent_workers'] and not kwargs['pin_memory']
+
+
+def test_dataloader_kwargs_default_num_workers(monkeypatch, tensor_datamodule) -> None:
+    monkeypatch.setattr(os, 'sched_getaffinity', lambda pid: set(range(16)), raising=False)
+    monkeypatch.setenv('WORLD_SIZE', '1')
+    datamodule = tensor_datamodule(num_workers=None)
+    assert datamodule.num_workers is None
+    assert datamodule._dataloader_kwargs()['num_workers'] == 8
+
+    # The world size is read from the trainer once it is attached, e.g. before DDP sets WORLD_SIZE
+    datamodule.trainer = SimpleNamespace(reload_dataloaders_every_n_epochs=0, world_size=4)
+    assert datamodule._dataloader_kwargs()['num_workers'] == 4
+    datamodule.setup()
+    assert datamodule.train_dataloader().num_workers == 4
+
+
+def test_tune_num_workers(tmp_path, tensor_datamodule) -> None:
+    datamodule = tensor_datamodule(num_workers=3)
+    assert tune_num_workers(datamodule, candidates=(0,), log_dir=tmp_path) == 0
+    assert (tmp_path / 'num_workers.yaml').exists()
+
+    # The cached value is re-used without loading data again
+    datamodule = tensor_datamodule(num_workers=3)
+    assert tune_num_workers(datamodule, candidates=(1, 2), log_dir=tmp_path) == 0
+    assert datamodule.num_workers == 0
+    assert datamodule.dataset_train is None
+
+
+def test_index_only_dataloader() -> None:
+    x = torch.arange(20, dtype=torch.float32).reshape(10, 2)
+    y = torch.arange(10)
+    dataset = TensorDataset(x, y)
+    loader = IndexOnlyDataLoader(dataset, (x, y), batch_size=4)
+
+    batches = list(loader)
+    assert len(loader) == len(batches) == 3
+    assert [len(batch[1]) for batch in batches] == [4, 4, 2]
+    assert torch.equal(torch.cat([batch[0] for batch in batches]), x)
+    assert torch.equal(torch.cat([batch[1] for batch in batches]), y)
+    assert list(loader.batch_sampler)[-1] == [8, 9]
+
+
+@pytest.mark.skipif(not torch.cuda.is_available(), reason="requires a CUDA device")
+def test_cuda_prefetcher() -> None:
+    x = torch.arange(20, dtype=torch.float32).reshape(10, 2)
+    y = torch.arange(10)
+    loader = DataLoader(TensorDataset(x, y), batch_size=4, pin_memory=True)
+    prefetcher = CudaPrefetcher(loader)
+
+    batches = list(prefetcher)
+    assert len(prefetcher) == len(batches) == 3
+    assert all(t.is_cuda for batch in batches for t in batch)
+    assert torch.equal(torch.cat([batch[0] for batch in batches]).cpu(), x)
+    assert torch.equal(torch.cat([batch[1] for batch in batches]).cpu(), y)
+    assert prefetcher.dataset is loader.dataset
+
+
+def test_train_dataloader_without_cuda_prefetch(monkeypatch, tensor_datamodule) -> None:
+    datamodule = tensor_datamodule(num_workers=0, cuda_prefetch=True)
+    datamodule.setup(stage='fit')
+
+    monkeypatch.setattr(torch.cuda, 'is_available', lambda: False)
+    assert type(datamodule.train_dataloader()) is DataLoader
+
+    # Distributed training needs the raw DataLoader
+    monkeypatch.setattr(torch.cuda, 'is_available', lambda: True)
+    datamodule.trainer = SimpleNamespace(reload_dataloaders_every_n_epochs=0, world_size=2,
+                                         strategy=SimpleNamespace(root_device=torch.device('cuda', 0)))
+    assert type(datamodule.train_dataloader()) is DataLoader
@@ -2,10 +2,16 @@
 from __future__ import annotations
 
 import numpy as np
+import pandas as pd
 from torchgeo.datasets import BoundingBox
 
 from malpolon.data.utils import (get_files_path_recursively, is_bbox_contained,
-                                 is_point_in_bbox, to_one_hot_encoding)
+                                 is_bbox_contained_batch, is_point_in_bbox,
+                                 iter_files_path_recursively, label_index_map,
+                                 split_obs_per_species_frequency,
+                                 split_obs_spatially,
+                                 to_one_hot_encoding,
+                                 to_one_hot_encoding_batch)
 
 
 def test_is_bbox_contained() -> None:
@@ -18,6 +24,15 @@ def test_is_bbox_contained() -> None:
     tg_bbox2 = BoundingBox(bbox2[0], bbox2[2], bbox2[1], bbox2[3], 0, 10)
     ibc_torchgeo = is_bbox_contained(tg_bbox1, tg_bbox2, method='torchgeo')
     assert all([ibc_manual, ibc_shapely, ibc_torchgeo])
+    assert not is_bbox_contained([1, 2, 11, 8], bbox2)
+
+def test_is_bbox_contained_batch() -> None:
+    bboxes1 = np.array([[1, 2, 9, 8], [-1, 2, 9, 8], [0, 0, 10, 10], [1, 2, 9, 11]])
+    bbox2 = [0, 0, 10, 10]
+    expected = np.array([True, False, True, False])
+    res = is_bbox_contained_batch(bboxes1, bbox2)
+    assert np.array_equal(res, expected)
+    assert np.array_equal(res, [is_bbox_contained(b, bbox2) for b in bboxes1])
 
 def test_is_point_in_bbox() -> None:
     point = (5, 5)
@@ -36,6 +51,23 @@ def test_to_one_hot_encoding() -> None:
     assert np.array_equal(res1, expected1)
     assert np.array_equal(res2, expected2)
 
+    label_to_idx = label_index_map(np.array(labels_target))
+    assert np.array_equal(to_one_hot_encoding(np.array([0, 3, 4, 7]), labels_target, label_to_idx), expected1)
+    assert np.array_equal(to_one_hot_encoding(np.int64(0), labels_target, label_to_idx), expected2)
+
+def test_to_one_hot_encoding_batch() -> None:
+    labels_predict = np.array([[0, 3], [4, 4], [1, 7]])
+    labels_target = np.array([0, 1, 2, 3, 4])
+    expected = np.array([[1, 0, 0, 1, 0],
+                         [0, 0, 0, 0, 1],
+                         [0, 1, 0, 0, 0]])
+    res = to_one_hot_encoding_batch(labels_predict, labels_target)
+    assert np.array_equal(res, expected)
+    for row, labels in zip(res, labels_predict):
+        assert np.array_equal(row, to_one_hot_encoding(labels, labels_target))
+    assert np.array_equal(to_one_hot_encoding_batch(labels_predict, labels_target,
+                                                    label_index_map(labels_target)), expected)
+
 def test_get_files_path_recursively() -> None:
     """Test get_files_path_recursively.
 
@@ -58,4 +90,37 @@ def test_get_files_path_recursively() -> None:
             expected[k] = path + v
     assert set(res1) == set(expected1)
     assert set(res2) == set(expected2)
-    assert set(res3) == set(expected3)
\ No newline at end of file
+    assert set(res3) == set(expected3)
+    assert set(iter_files_path_recursively(path, '.txt', 'md', 'rtf')) == set(expected2)
+    assert set(get_files_path_recursively(path, 'txt', 'rtf', suffix='_d.*p')) == set(expected1[1:] + expected3)
+    # Extensions are regular expressions too
+    assert set(get_files_path_recursively(path, 'tx?t', 'm[a-z]', 'rtff?')) == set(expected2)
+    assert set(get_files_path_recursively(path, 'rtff?', suffix='_deep')) == set(expected3)
+
+def test_split_obs_per_species_frequency(tmp_path) -> None:
+    species = ['a'] * 40 + ['b'] * 20 + ['c'] * 5 + ['d'] * 2
+    pd.DataFrame({'obsId': range(len(species)), 'speciesId': species}).to_csv(tmp_path / 'obs.csv', index=False)
+    split_obs_per_species_frequency(str(tmp_path / 'obs.csv'), str(tmp_path / 'obs'), val_ratio=0.1, keep_rares=1)
+    df_train = pd.read_csv(tmp_path / 'obs_split-10.0%_train.csv')
+    df_val = pd.read_csv(tmp_path / 'obs_split-10.0%_val.csv')
+    assert df_val['speciesId'].value_counts().to_dict() == {'a': 4, 'b': 2, 'c': 1, 'd': 1}
+    assert set(df_train['obsId']).isdisjoint(df_val['obsId'])
+    assert len(df_train) + len(df_val) == len(species)
+    assert (df_val['subset'] == 'val').all() and (df_train['subset'] == 'train').all()
+
+def test_split_obs_spatially(tmp_path) -> None:
+    rng = np.random.default_rng(0)
+    n_obs = 200
+    df = pd.DataFrame({'obsId': range(n_obs),
+                       'lat': rng.uniform(40, 50, n_obs),
+                       'lon': rng.uniform(0, 10, n_obs),
+                       'speciesId': rng.integers(0, 5, n_obs)})
+    df.to_csv(tmp_path / 'obs.csv', index=False)
+    split_obs_spatially(str(tmp_path / 'obs.csv'), spacing=1, val_size=0.2)
+    df_train_val = pd.read_csv(tmp_path / 'obs_train_val-60min.csv')
+    df_val = pd.read_csv(tmp_path / 'obs_val-60min.csv')
+    assert list(df_train_val.columns) == ['lon', 'lat', 'subset', 'obsId', 'speciesId']
+    assert len(df_train_val) == n_obs and 0 < len(df_val) < n_obs
+    assert set(df_val['subset']) == {'val'}
+    df_ref = df.set_index('obsId').loc[df_train_val['obsId']]
+    assert np.allclose(df_ref['lon'], df_train_val['lon']) and np.allclose(df_ref['lat'], df_train_val['lat'])
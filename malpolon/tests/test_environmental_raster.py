@@ -8,7 +8,8 @@ from pathlib import Path
 import numpy as np
 import pytest
 
-from malpolon.data.environmental_raster import PatchExtractor
+from malpolon.data.environmental_raster import (MemmapPatchExtractor,
+                                                 PatchExtractor)
 
 DATA_PATH = Path("malpolon/tests/data/")
 
@@ -167,6 +168,20 @@ def test_patch_extractor_out_of_bounds(size):
             assert patch.shape == (1, size, size)
 
 
+@pytest.mark.parametrize("size", (1, 8))
+def test_patch_extractor_prebake(tmp_path, size):
+    extractor = PatchExtractor(DATA_PATH / "bioclimatic_rasters", size=size)
+    extractor.append("bio_1")
+    extractor.append("bio_2")
+    points = np.array([[43.61, 3.88], [48.85, 2.35], [43.3, 5.37]])
+    extractor.prebake(points, tmp_path / "patches.npy", dtype=np.float32)
+
+    memmap_extractor = MemmapPatchExtractor(tmp_path / "patches.npy")
+    assert len(memmap_extractor) == len(extractor)
+    for lat, lon in points:
+        np.testing.assert_array_equal(memmap_extractor[lat, lon], extractor[lat, lon])
+
+
 def test_patch_plotting():
     extractor = PatchExtractor(DATA_PATH / "bioclimatic_rasters", size=256)
     extractor.append("bio_1")
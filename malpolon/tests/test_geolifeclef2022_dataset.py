@@ -129,6 +129,29 @@ def test_dataset_load_all():
     assert len(data["environmental_patches"]) == 27
 
 
+@pytest.mark.parametrize("use_cache_dir", (False, True))
+def test_dataset_load_in_memory(tmp_path, use_cache_dir):
+    patch_extractor = PatchExtractor(DATA_PATH / "rasters", size=8)
+    patch_extractor.append("bio_1")
+    dataset = GeoLifeCLEF2022Dataset(
+        DATA_PATH, "train", use_rasters=True, patch_extractor=patch_extractor
+    )
+    # Only the first observations have patches in the test data
+    dataset.observation_ids = dataset.observation_ids[:1]
+    dataset.coordinates = dataset.coordinates[:1]
+    dataset.targets = dataset.targets[:1]
+    data_expected, target_expected = dataset[0]
+
+    dataset.load_in_memory(tmp_path if use_cache_dir else None)
+    data, target = dataset[0]
+    assert target == target_expected
+    assert data.keys() == data_expected.keys()
+    for key, patch in data.items():
+        np.testing.assert_array_equal(patch, data_expected[key])
+    if use_cache_dir:
+        assert len(list(tmp_path.glob("*.npy"))) == len(data)
+
+
 @pytest.mark.parametrize("observation_id", (10561900, 22068100))
 def test_patch_plotting(observation_id):
     patch = load_patch(observation_id, DATA_PATH)
@@ -8,9 +8,12 @@ import timm
 import torch
 from torchvision import models
 
+from malpolon.models.custom_models.multi_modal import \
+    HomogeneousMultiModalModel
 from malpolon.models.model_builder import (
     change_first_convolutional_layer_modifier, change_last_layer_modifier,
     timm_model_provider, torchvision_model_provider)
+from malpolon.models.standard_prediction_systems import ClassificationSystem
 
 
 def test_change_first_convolutional_layer():
@@ -81,3 +84,52 @@ def test_timm_model_provider():
     model_name = 'resnet18'
     model = timm_model_provider(model_name, **model_kwargs)
     assert isinstance(model, timm.models.resnet.ResNet)
+
+
+def test_homogeneous_multi_modal_model_stacked_input():
+    modalities_model = {
+        "provider_name": "torchvision",
+        "model_name": "resnet18",
+        "model_kwargs": {"weights": None},
+        "modifiers": {"change_last_layer": {"num_outputs": 4}},
+    }
+    model = HomogeneousMultiModalModel(
+        ["rgb", "temperature"],
+        modalities_model,
+        torch.nn.Linear(8, 5),
+    )
+    model.eval()
+
+    x = torch.rand(2, 6, 64, 64)
+    with torch.no_grad():
+        y_stacked = model(x)
+        y_dict = model({"rgb": x[:, :3], "temperature": x[:, 3:]})
+
+    assert y_stacked.shape == (2, 5)
+    assert torch.allclose(y_stacked, y_dict)
+
+
+def test_homogeneous_multi_modal_model_channels_last_inputs():
+    modalities_model = {
+        "provider_name": "torchvision",
+        "model_name": "resnet18",
+        "model_kwargs": {"weights": None},
+        "modifiers": {"change_last_layer": {"num_outputs": 4}},
+    }
+    model = HomogeneousMultiModalModel(
+        ["rgb", "temperature"],
+        modalities_model,
+        torch.nn.Linear(8, 5),
+    )
+    system = ClassificationSystem(model, task='classification_multiclass', hparams_preprocess=False,
+                                  metrics={}, channels_last=True)
+    system.eval()
+
+    inputs = []
+    for modality_model in model.modality_models.values():
+        modality_model.register_forward_pre_hook(lambda module, args: inputs.append(args[0]))
+    with torch.no_grad():
+        system(torch.rand(2, 6, 64, 64))
+
+    assert len(inputs) == 2
+    assert all(x.is_contiguous(memory_format=torch.channels_last) for x in inputs)
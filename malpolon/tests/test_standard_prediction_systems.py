@@ -4,9 +4,12 @@ Author: Theo Larcher <theo.larcher@inria.fr>
 """
 
 import numpy as np
+import pytorch_lightning as pl
 import timm
+import torch
 
-from malpolon.models.standard_prediction_systems import GenericPredictionSystem
+from malpolon.models.standard_prediction_systems import (
+    ClassificationSystem, GenericPredictionSystem)
 
 
 def test_state_dict_replace_key():
@@ -21,3 +24,33 @@ def test_state_dict_replace_key():
     res = lambda keys, pos: all((sd_replace_key[1] in keys[i]) and
                                 (sd_replace_key[0] not in keys[i]) for i in pos)
     assert res(keys_new, keys_pos)
+
+
+class _ScaledInputClassificationSystem(ClassificationSystem):
+    def on_after_batch_transfer(self, batch, dataloader_idx):
+        x, y = batch
+        return x * 2, y
+
+
+def test_predict_runs_model_batch_hooks(tensor_datamodule):
+    x = torch.rand(10, 4)
+    y = torch.zeros(10, dtype=torch.long)
+    datamodule = tensor_datamodule(x, y, num_workers=0)
+    system = _ScaledInputClassificationSystem(torch.nn.Linear(4, 3), task='classification_multiclass',
+                                              hparams_preprocess=False)
+    trainer = pl.Trainer(accelerator='cpu', devices=1, logger=False, enable_progress_bar=False,
+                         enable_model_summary=False)
+
+    predictions = system.predict(datamodule, trainer)
+
+    with torch.no_grad():
+        assert torch.allclose(predictions, system.model(x * 2))
+
+
+def test_loss_in_full_precision_under_autocast():
+    system = ClassificationSystem(torch.nn.Linear(4, 3), task='classification_multiclass',
+                                  hparams_preprocess=False, metrics={})
+    batch = (torch.rand(8, 4), torch.zeros(8, dtype=torch.long))
+    with torch.autocast(device_type='cpu', dtype=torch.bfloat16):
+        loss = system._step('train', batch, 0)
+    assert loss.dtype == torch.float32